@@ -1,24 +1,34 @@
 import os
 import logging
 import hashlib
-import json
-import requests
+import heapq
 import re
 import asyncio
+import time
+import random
+import threading
 import aiohttp
-import traceback
+import xxhash
+import orjson
+from cachetools import LRUCache
 from pathlib import Path
+from collections import Counter, defaultdict
+from functools import lru_cache
 from typing import Dict, List, Tuple, Optional
 from datetime import datetime
-from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
 
 import ollama
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import RetryAfter, BadRequest, TelegramError
+from telegram.request import HTTPXRequest
 from telegram.ext import (
     Application, CommandHandler, MessageHandler,
     filters, CallbackContext, CallbackQueryHandler,
     ContextTypes
 )
+import fitz  # PyMuPDF
 import PyPDF2
 import pdfplumber
 
@@ -38,62 +48,246 @@ PDF_FOLDER = Path("pdf_documents")
 PDF_FOLDER.mkdir(exist_ok=True)
 OLLAMA_MODEL = "qwen2.5:14b-instruct-q4_K_M"
 CACHE_FILE = "documents_cache.json"
+CHUNKS_FILE = "chunks.jsonl"
+HANDLED_FILE = "handled_updates.json"  # update_id отвеченных сообщений (переживает перезапуск)
+HANDLED_KEEP = 1000  # Сколько последних отвеченных update_id помнить
+CACHE_SCHEMA_VERSION = 8  # Увеличивать при любом изменении формата чанков/индекса
 OLLAMA_TIMEOUT = 60  # Увеличиваем таймаут для Ollama
 TELEGRAM_TIMEOUT = 30  # Таймаут для Telegram
+TELEGRAM_CONNECT_TIMEOUT = 5  # Таймаут соединения с Telegram (короткий, чтобы быстро замечать сбои сети)
+TELEGRAM_POOL_SIZE = 100  # Соединений в пуле для запросов к Telegram API
+MESSAGE_PART_LEN = 4000  # Длиннее ответ отправляется частями (лимит Telegram - 4096 символов)
 INTERNET_TIMEOUT = 10  # Таймаут для интернет-запросов
+# Извлекать таблицы (через pdfplumber, заметно медленнее). При смене значения документы обрабатываются заново
+EXTRACT_TABLES = os.getenv("EXTRACT_TABLES", "0") == "1"
+OLLAMA_OPTIONS = {
+    'temperature': 0.3,
+    'num_predict': 1200,
+    'num_thread': 4  # Увеличиваем производительность
+}
+STREAM_EDIT_INTERVAL = 1.0  # Не чаще одного редактирования сообщения в секунду (лимит Telegram)
+STREAM_EDIT_MIN_CHARS = 200  # Минимальный прирост текста между редактированиями
+CHAT_SEND_RATE = 1.0  # Сообщений в секунду на чат (лимит Telegram)
+CHAT_SEND_BURST = 3  # Столько сообщений подряд можно отправить в чат без ожидания
+SEND_RETRIES = 3  # Попыток отправки при RetryAfter от Telegram
+SEND_DRAIN_TIMEOUT = 10  # Сколько секунд при остановке ждать отправки оставшихся частей ответов
+ANSWER_CACHE_SIZE = 512  # Сколько готовых ответов на повторяющиеся вопросы хранить в памяти
+
+# Ответы на вопросы отправляются в MarkdownV2: текст модели экранируется целиком одним str.translate
+_MD2_TABLE = str.maketrans({c: '\\' + c for c in '\\_*[]()~`>#+-=|{}.!'})
+
+# Подписи источника ответа (MarkdownV2)
+NOT_FOUND_SUFFIX = "⚠️ *Источник:* Информация не найдена"
+SOURCE_SUFFIXES = {
+    "documents": "📚 *Источник:* Документы из папки",
+    "documents_timeout": "📚⏱️ *Источник:* Документы \\(обработка с таймаутом\\)",
+    "internet": "🌐 *Источник:* Интернет \\(открытые источники\\)",
+    "internet_raw": "🌐 *Источник:* Необработанные данные из интернета",
+}
+TIMEOUT_MSG = (
+    "⏱️ *Таймаут обработки*\n"
+    "Запрос занял слишком много времени. Попробуйте:\n"
+    "1. Переформулировать вопрос\n"
+    "2. Задать более конкретный вопрос\n"
+    "3. Проверить доступность модели Ollama"
+)
 
-# Глобальный пул потоков для тяжелых операций
-executor = ThreadPoolExecutor(max_workers=4)
+# Неизменные части сообщения /status
+STATUS_HEADER = f"\n📊 *Статус системы:*\n\n🤖 *Модель:* {OLLAMA_MODEL}\n"
+STATUS_FOOTER = f"⏱️ *Таймаут Ollama:* {OLLAMA_TIMEOUT} сек\n\n📁 *Папка с документами:* `{PDF_FOLDER}`\n"
+
+# Регулярные выражения (компилируем один раз)
+_WORD_RE = re.compile(r'\b[a-zA-Zа-яА-ЯёЁ]{3,}\b')
+_PAGE_SPLIT_RE = re.compile(r'\n={10,}\nСтраница \d+\n={10,}\n')
+_PARA_SPLIT_RE = re.compile(r'\n\s*\n')
+_SENT_SPLIT_RE = re.compile(r'(?<=[.!?])\s+')
+_MD2_ESCAPE_RE = re.compile(r'\\(.)', re.DOTALL)
+_STANDARD_RE = re.compile(r'((?:ГОСТ|ISO|СТ|EN)\s*[0-9.\-]+|[0-9.\-]+\s*(?:ГОСТ|ISO))', re.IGNORECASE)
+
+# Служебные слова, которые не считаем ключевыми
+_STOP_WORDS = frozenset({
+    'и', 'в', 'на', 'с', 'по', 'для', 'от', 'до', 'из', 'не',
+    'что', 'это', 'как', 'так', 'или', 'но', 'за', 'же', 'бы',
+    'the', 'and', 'of', 'to', 'in', 'a', 'is', 'that', 'for',
+    'iso', 'гост', 'стандарт', 'документ', 'страница'
+})
+
+# Пул процессов для разбора PDF (CPU) и пул потоков для запросов к Ollama и прочего ввода-вывода
+THREAD_POOL_SIZE = int(os.getenv("THREAD_POOL_SIZE", min(32, (os.cpu_count() or 4) * 4)))
+_cpu_pool = ProcessPoolExecutor(max_workers=os.cpu_count())
+_io_pool = ThreadPoolExecutor(max_workers=THREAD_POOL_SIZE)
+
+
+def _restart_cpu_pool():
+    """Пересоздаем пул процессов: после падения воркера старый пул больше не принимает задачи"""
+    global _cpu_pool
+    _cpu_pool.shutdown(wait=False, cancel_futures=True)
+    _cpu_pool = ProcessPoolExecutor(max_workers=os.cpu_count())
+
+
+@lru_cache(maxsize=4096)
+def _standard_number(filename: str) -> Optional[str]:
+    """Номер стандарта по названию файла (результат кэшируется)"""
+    match = _STANDARD_RE.search(filename)
+    if match:
+        return match.group(1)
+    return None
+
+
+def _short(e: BaseException, n: int = 200) -> str:
+    """Короткий текст ошибки: берем первый аргумент, не собирая целиком str(e)"""
+    msg = e.args[0] if e.args else repr(e)
+    return msg[:n] if isinstance(msg, str) else repr(e)[:n]
+
+
+def _md2(text: str) -> str:
+    """Экранируем текст для parse_mode='MarkdownV2'"""
+    return text.translate(_MD2_TABLE)
+
+
+def _split_md2(text: str, limit: int = MESSAGE_PART_LEN):
+    """Режем MarkdownV2-текст на части не длиннее limit: по возможности по переводу строки
+    и никогда не отрывая экранирующий \\ от следующего за ним символа"""
+    start = 0
+    n = len(text)
+    while n - start > limit:
+        # Перевод строки ищем во второй половине части, чтобы не плодить короткие куски
+        end = text.rfind("\n", start + limit // 2, start + limit)
+        end = start + limit if end == -1 else end + 1
+        # Нечетное число \\ перед разрезом - последний из них экранирует первый символ следующей части
+        k = end
+        while k > start and text[k - 1] == "\\":
+            k -= 1
+        if (end - k) % 2:
+            end -= 1
+        yield text[start:end]
+        start = end
+    yield text[start:]
 
 
 class AdvancedPDFProcessor:
     """Продвинутый обработчик PDF с кэшированием и семантическим поиском"""
 
-    def __init__(self):
+    def __init__(self, autoload: bool = True):
         self.documents_cache: Dict[str, Dict] = {}
         self.chunk_index: Dict[str, List[Dict]] = {}
-        self.load_cache()
-        self.update_documents()
+        # Инвертированный индекс: слово -> [(файл, номер чанка)]
+        self.postings: Dict[str, List[Tuple[str, int]]] = {}
+        # Файлы, чьи чанки изменились с последнего сохранения
+        self._dirty_files = set()
+        # Кэш изменен в памяти и еще не сохранен на диск
+        self._dirty = False
+        # Кэш уже сохранялся в текущем проходе update_documents
+        self._saved_this_run = False
+        # Итоги для статистики (поддерживаются при каждом изменении кэша)
+        self._chunk_total = 0
+        self._size_total = 0
+        # Общая HTTP-сессия (создается при первом запросе)
+        self._http_session: Optional[aiohttp.ClientSession] = None
+        if autoload:
+            self.load_cache()
+            self.update_documents()
 
     def load_cache(self):
         """Загружаем кэш документов"""
         if os.path.exists(CACHE_FILE):
             try:
-                with open(CACHE_FILE, 'r', encoding='utf-8') as f:
-                    cache_data = json.load(f)
-                    self.documents_cache = cache_data.get('documents', {})
-                    self.chunk_index = cache_data.get('chunks', {})
+                cache_data = orjson.loads(Path(CACHE_FILE).read_bytes())
+                if cache_data.get('schema_version') != CACHE_SCHEMA_VERSION:
+                    logger.warning("Версия формата кэша не совпадает, документы будут обработаны заново")
+                    return
+
+                self.documents_cache = cache_data.get('documents', {})
+
+                # Чанки хранятся построчно в отдельном файле
+                self.chunk_index = {}
+                if os.path.exists(CHUNKS_FILE):
+                    self.chunk_index = {filename: [] for filename in self.documents_cache}
+                    with open(CHUNKS_FILE, 'rb') as f:
+                        for line in f:
+                            chunk = orjson.loads(line)
+                            chunk["token_set"] = frozenset(chunk.get("token_set", ()))
+                            if chunk["source"] in self.chunk_index:
+                                self.chunk_index[chunk["source"]].append(chunk)
+
+                # Файл чанков не дописан (сбой между записями) - такие документы обработаем заново
+                for filename, chunks in list(self.chunk_index.items()):
+                    if len(chunks) != self.documents_cache[filename].get("chunk_count"):
+                        logger.warning(f"Чанки {filename} в кэше неполные, документ будет обработан заново")
+                        del self.chunk_index[filename]
+
+                # Индекс не храним: строим по token_set загруженных чанков, чтобы он всегда им соответствовал
+                self.rebuild_postings()
+                self._recount_totals()
                 logger.info(f"Загружен кэш: {len(self.documents_cache)} документов")
             except Exception as e:
                 logger.error(f"Ошибка загрузки кэша: {e}")
                 self.documents_cache = {}
                 self.chunk_index = {}
+                self.postings = {}
+                self._recount_totals()
+
+    @property
+    def chunk_total(self) -> int:
+        """Общее число чанков"""
+        return self._chunk_total
+
+    @property
+    def size_total(self) -> int:
+        """Общий размер документов в байтах"""
+        return self._size_total
+
+    def _recount_totals(self):
+        """Пересчитываем итоги по кэшу целиком"""
+        self._chunk_total = sum(map(len, self.chunk_index.values()))
+        self._size_total = sum(doc.get("file_size", 0) for doc in self.documents_cache.values())
 
     def save_cache(self):
         """Сохраняем кэш"""
         try:
             cache_data = {
+                'schema_version': CACHE_SCHEMA_VERSION,
                 'documents': self.documents_cache,
-                'chunks': self.chunk_index,
                 'updated_at': datetime.now().isoformat()
             }
-            with open(CACHE_FILE, 'w', encoding='utf-8') as f:
-                json.dump(cache_data, f, ensure_ascii=False, indent=2)
+            Path(CACHE_FILE).write_bytes(orjson.dumps(cache_data))
+
+            # Чанки перезаписываем, только если они менялись
+            if self._dirty_files or not os.path.exists(CHUNKS_FILE):
+                with open(CHUNKS_FILE, 'wb') as f:
+                    for chunks in self.chunk_index.values():
+                        for chunk in chunks:
+                            f.write(orjson.dumps(chunk, default=list))
+                            f.write(b"\n")
+                self._dirty_files.clear()
+
+            self._dirty = False
             logger.info(f"Кэш сохранен в {CACHE_FILE}")
         except Exception as e:
             logger.error(f"Ошибка сохранения кэша: {e}")
 
+    def _maybe_save(self):
+        """Сохраняем кэш, только если он изменился (одна запись на все обновление)"""
+        if not self._dirty:
+            return
+
+        if self._saved_this_run:
+            logger.warning("Кэш сохраняется несколько раз за одно обновление - сохраняйте один раз после обработки всех файлов")
+        self._saved_this_run = True
+
+        self.save_cache()
+
     def calculate_file_hash(self, file_path: Path) -> str:
-        """Хеш файла для отслеживания изменений"""
-        hasher = hashlib.md5()
+        """Хеш файла для отслеживания изменений (читаем блоками по 1 МБ)"""
+        hasher = xxhash.xxh3_64()
         with open(file_path, 'rb') as f:
-            buf = f.read()
-            hasher.update(buf)
+            for block in iter(lambda: f.read(1 << 20), b''):
+                hasher.update(block)
         return hasher.hexdigest()
 
-    def extract_text_advanced(self, file_path: Path) -> Tuple[str, Dict]:
+    def extract_text_advanced(self, file_path: Path, need_tables: bool = False) -> Tuple[str, Dict]:
         """Улучшенное извлечение текста с сохранением структуры"""
-        text = ""
+        parts: List[str] = []
         metadata = {
             "pages": 0,
             "sections": [],
@@ -102,8 +296,41 @@ class AdvancedPDFProcessor:
             "extraction_method": "unknown"
         }
 
+        if not need_tables:
+            try:
+                # Метод 1: PyMuPDF (самый быстрый, таблицы не извлекает)
+                with fitz.open(file_path) as doc:
+                    metadata["pages"] = doc.page_count
+                    metadata["extraction_method"] = "pymupdf"
+
+                    for i, page in enumerate(doc, 1):
+                        try:
+                            page_text = page.get_text("text")
+                            if page_text:
+                                # Сохраняем структуру документа
+                                parts.append(f"\n{'=' * 60}\nСтраница {i}\n{'=' * 60}\n{page_text}\n")
+                                self._collect_sections(page_text, metadata["sections"])
+
+                            # Проверяем наличие изображений
+                            images = page.get_images(full=False)
+                            if images:
+                                metadata["images_found"] += len(images)
+                                parts.append(f"\n[Обнаружено изображений на странице {i}: {len(images)}]\n")
+
+                        except Exception as e:
+                            logger.warning(f"Ошибка обработки страницы {i}: {e}")
+                            continue
+
+                    return "".join(parts), metadata
+
+            except Exception as e:
+                logger.warning(f"PyMuPDF error: {e}")
+                parts.clear()
+                metadata["sections"] = []
+                metadata["images_found"] = 0
+
         try:
-            # Метод 1: pdfplumber (лучший для структурированных PDF)
+            # Метод 2: pdfplumber (медленнее, но умеет извлекать таблицы)
             with pdfplumber.open(file_path) as pdf:
                 metadata["pages"] = len(pdf.pages)
                 metadata["extraction_method"] = "pdfplumber"
@@ -114,40 +341,38 @@ class AdvancedPDFProcessor:
                         page_text = page.extract_text()
                         if page_text:
                             # Сохраняем структуру документа
-                            text += f"\n{'=' * 60}\nСтраница {i}\n{'=' * 60}\n{page_text}\n"
-
-                            # Извлекаем заголовки (строки в верхнем регистре)
-                            lines = page_text.split('\n')
-                            for line in lines:
-                                clean_line = line.strip()
-                                if (len(clean_line) > 3 and len(clean_line) < 100 and
-                                        clean_line.isupper() and clean_line not in metadata["sections"]):
-                                    metadata["sections"].append(clean_line)
-
-                        # Проверяем наличие таблиц
-                        try:
-                            tables = page.extract_tables()
-                            if tables:
-                                metadata["tables_found"] += len(tables)
-                                text += f"\n[Обнаружено таблиц на странице {i}: {len(tables)}]\n"
-                        except Exception as e:
-                            logger.debug(f"Ошибка извлечения таблиц: {e}")
+                            parts.append(f"\n{'=' * 60}\nСтраница {i}\n{'=' * 60}\n{page_text}\n")
+                            self._collect_sections(page_text, metadata["sections"])
+
+                        # Проверяем наличие таблиц (дорогая операция - только по запросу)
+                        if need_tables:
+                            try:
+                                tables = page.extract_tables()
+                                if tables:
+                                    metadata["tables_found"] += len(tables)
+                                    parts.append(f"\n[Обнаружено таблиц на странице {i}: {len(tables)}]\n")
+                            except Exception as e:
+                                logger.debug(f"Ошибка извлечения таблиц: {e}")
 
                         # Проверяем наличие изображений
                         if page.images:
                             metadata["images_found"] += len(page.images)
-                            text += f"\n[Обнаружено изображений на странице {i}: {len(page.images)}]\n"
+                            parts.append(f"\n[Обнаружено изображений на странице {i}: {len(page.images)}]\n")
 
                     except Exception as e:
                         logger.warning(f"Ошибка обработки страницы {i}: {e}")
                         continue
+                    finally:
+                        # Освобождаем разобранные объекты страницы, чтобы память не росла с числом страниц
+                        page.flush_cache()
 
-                return text, metadata
+                return "".join(parts), metadata
 
         except Exception as e:
             logger.warning(f"pdfplumber error: {e}")
+            parts.clear()
             try:
-                # Метод 2: PyPDF2 (резервный)
+                # Метод 3: PyPDF2 (резервный)
                 with open(file_path, 'rb') as file:
                     reader = PyPDF2.PdfReader(file)
                     metadata["pages"] = len(reader.pages)
@@ -156,14 +381,23 @@ class AdvancedPDFProcessor:
                     for i, page in enumerate(reader.pages, 1):
                         page_text = page.extract_text()
                         if page_text:
-                            text += f"\n{'=' * 60}\nСтраница {i}\n{'=' * 60}\n{page_text}\n"
+                            parts.append(f"\n{'=' * 60}\nСтраница {i}\n{'=' * 60}\n{page_text}\n")
 
-                    return text, metadata
+                    return "".join(parts), metadata
 
             except Exception as e2:
                 logger.error(f"PyPDF2 error: {e2}")
                 return "", metadata
 
+    @staticmethod
+    def _collect_sections(page_text: str, sections: List[str]):
+        """Извлекаем заголовки (строки в верхнем регистре)"""
+        for line in page_text.split('\n'):
+            clean_line = line.strip()
+            if (len(clean_line) > 3 and len(clean_line) < 100 and
+                    clean_line.isupper() and clean_line not in sections):
+                sections.append(clean_line)
+
     def chunk_text_intelligently(self, text: str, filename: str) -> List[Dict]:
         """Интеллектуальное разбиение текста на чанки с семантическим группированием"""
         if not text:
@@ -172,97 +406,102 @@ class AdvancedPDFProcessor:
         chunks = []
 
         # Разбиваем по страницам (если есть маркеры страниц)
-        page_markers = re.split(r'\n={10,}\nСтраница \d+\n={10,}\n', text)
+        page_markers = _PAGE_SPLIT_RE.split(text)
 
         if len(page_markers) > 1:
             # Используем разбиение по страницам
             for i, page_text in enumerate(page_markers[1:], 1):
                 if page_text.strip():
-                    # Разбиваем страницу на абзацы
-                    paragraphs = re.split(r'\n\s*\n', page_text)
-                    current_chunk = ""
+                    # Разбиваем страницу на абзацы (собираем чанк списком, без квадратичных +=)
+                    paragraphs = _PARA_SPLIT_RE.split(page_text)
+                    buf: List[str] = []
+                    buf_len = 0
 
                     for para in paragraphs:
-                        if len(current_chunk) + len(para) < 1500:
-                            current_chunk += para + "\n\n"
+                        if buf_len + len(para) < 1500:
+                            buf.append(para)
+                            buf.append("\n\n")
+                            buf_len += len(para) + 2
                         else:
-                            if current_chunk.strip():
+                            current_chunk = "".join(buf).strip()
+                            if current_chunk:
                                 chunks.append({
-                                    "text": current_chunk.strip(),
+                                    "text": current_chunk,
                                     "page": i,
                                     "source": filename,
                                     "chunk_type": "page_section"
                                 })
-                            current_chunk = para + "\n\n"
+                            buf = [para, "\n\n"]
+                            buf_len = len(para) + 2
 
-                    if current_chunk.strip():
+                    current_chunk = "".join(buf).strip()
+                    if current_chunk:
                         chunks.append({
-                            "text": current_chunk.strip(),
+                            "text": current_chunk,
                             "page": i,
                             "source": filename,
                             "chunk_type": "page_section"
                         })
         else:
             # Разбиваем на смысловые блоки
-            sentences = re.split(r'(?<=[.!?])\s+', text)
-            current_chunk = ""
+            sentences = _SENT_SPLIT_RE.split(text)
+            buf = []
+            buf_len = 0
 
             for sentence in sentences:
-                if len(current_chunk) + len(sentence) < 1000:
-                    current_chunk += sentence + " "
+                if buf_len + len(sentence) < 1000:
+                    buf.append(sentence)
+                    buf.append(" ")
+                    buf_len += len(sentence) + 1
                 else:
-                    if current_chunk.strip():
+                    current_chunk = "".join(buf).strip()
+                    if current_chunk:
                         chunks.append({
-                            "text": current_chunk.strip(),
+                            "text": current_chunk,
                             "page": 0,
                             "source": filename,
                             "chunk_type": "semantic"
                         })
-                    current_chunk = sentence + " "
+                    buf = [sentence, " "]
+                    buf_len = len(sentence) + 1
 
-            if current_chunk.strip():
+            current_chunk = "".join(buf).strip()
+            if current_chunk:
                 chunks.append({
-                    "text": current_chunk.strip(),
+                    "text": current_chunk,
                     "page": 0,
                     "source": filename,
                     "chunk_type": "semantic"
                 })
 
-        # Извлекаем ключевые слова для каждого чанка
+        # Извлекаем ключевые слова и множество слов для каждого чанка (токенизируем один раз),
+        # хеш текста нужен для отсева повторов при индексации и поиске
         for chunk in chunks:
-            chunk["keywords"] = self.extract_keywords(chunk["text"])
+            words = _WORD_RE.findall(chunk["text"].lower())
+            chunk["keywords"] = self.extract_keywords(chunk["text"], words=words)
+            chunk["token_set"] = frozenset(words)
+            chunk["dedup_hash"] = xxhash.xxh3_64_intdigest(chunk["text"].encode())
 
         return chunks
 
-    def extract_keywords(self, text: str, max_keywords: int = 10) -> List[str]:
+    def extract_keywords(self, text: str, max_keywords: int = 10,
+                         words: Optional[List[str]] = None) -> List[Tuple[str, int]]:
         """Извлекаем ключевые слова из текста"""
-        # Убираем служебные слова
-        stop_words = {
-            'и', 'в', 'на', 'с', 'по', 'для', 'от', 'до', 'из', 'не',
-            'что', 'это', 'как', 'так', 'или', 'но', 'за', 'же', 'бы',
-            'the', 'and', 'of', 'to', 'in', 'a', 'is', 'that', 'for',
-            'iso', 'гост', 'стандарт', 'документ', 'страница'
-        }
+        # Находим слова (русские и английские), если они не переданы готовыми
+        if words is None:
+            words = _WORD_RE.findall(text.lower())
 
-        # Находим слова (русские и английские)
-        words = re.findall(r'\b[a-zA-Zа-яА-ЯёЁ]{3,}\b', text.lower())
+        # Сразу отбрасываем служебные слова
+        words = (word for word in words if word not in _STOP_WORDS)
 
-        # Считаем частоту
-        from collections import Counter
+        # Считаем частоту и выбираем наиболее частые
         word_counts = Counter(words)
-
-        # Фильтруем служебные слова и выбираем наиболее частые
-        keywords = []
-        for word, count in word_counts.most_common(20):
-            if word not in stop_words and len(word) > 2:
-                keywords.append(f"{word}:{count}")
-                if len(keywords) >= max_keywords:
-                    break
-
-        return keywords
+        return word_counts.most_common(max_keywords)
 
     def update_documents(self):
         """Обновляем документы с интеллектуальной обработкой"""
+        self._saved_this_run = False
+
         if not PDF_FOLDER.exists():
             PDF_FOLDER.mkdir()
             print(f"📁 Создана папка: {PDF_FOLDER}")
@@ -272,162 +511,273 @@ class AdvancedPDFProcessor:
         print(f"📁 Найдено PDF файлов: {len(pdf_files)}")
 
         updated_count = 0
-        self.chunk_index.clear()
 
+        # Убираем из кэша файлы, которых больше нет в папке
+        present = {pdf_file.name for pdf_file in pdf_files}
+        for filename in list(self.documents_cache):
+            if filename not in present:
+                self._size_total -= self.documents_cache.pop(filename).get("file_size", 0)
+                self._dirty = True
+        for filename in list(self.chunk_index):
+            if filename not in present:
+                self._chunk_total -= len(self.chunk_index.pop(filename))
+                self._dirty_files.add(filename)
+
+        # Отбираем новые/измененные файлы (хеш считаем здесь, чтобы не гонять воркеры зря)
+        pending: Dict[str, Tuple[str, os.stat_result]] = {}
         for pdf_file in pdf_files:
             try:
-                file_hash = self.calculate_file_hash(pdf_file)
+                st = pdf_file.stat()
                 filename = pdf_file.name
+                cached = self.documents_cache.get(filename)
 
-                # Проверяем, нужно ли обновлять
-                if filename in self.documents_cache:
-                    cached_hash = self.documents_cache[filename].get("file_hash", "")
-                    if cached_hash == file_hash:
-                        # Восстанавливаем чанки из кэша
-                        if filename in self.chunk_index:
-                            continue
+                # Документ обработан с другим режимом извлечения таблиц - обрабатываем заново
+                if cached and cached.get("tables_extracted", False) != EXTRACT_TABLES:
+                    cached = None
+
+                # Проверяем, нужно ли обновлять: сначала дешево по размеру и времени изменения
+                if (cached and filename in self.chunk_index and
+                        cached.get("file_size") == st.st_size and
+                        cached.get("mtime_ns") == st.st_mtime_ns):
+                    continue
+
+                # Размер или время изменились - сверяем содержимое
+                file_hash = self.calculate_file_hash(pdf_file)
+                if cached and filename in self.chunk_index and cached.get("file_hash") == file_hash:
+                    # Содержимое то же (например, файл скопировали заново) - восстанавливаем чанки из кэша
+                    cached["file_size"] = st.st_size
+                    cached["mtime_ns"] = st.st_mtime_ns
+                    self._dirty = True
+                    continue
 
-                # Обрабатываем новый/измененный файл
                 print(f"📄 Обрабатываю: {filename}")
-                text, metadata = self.extract_text_advanced(pdf_file)
-
-                if text and len(text.strip()) > 100:
-                    # Создаем чанки
-                    chunks = self.chunk_text_intelligently(text, filename)
-
-                    # Сохраняем в кэш
-                    self.documents_cache[filename] = {
-                        "file_hash": file_hash,
-                        "metadata": metadata,
-                        "text_preview": text[:1000],
-                        "chunk_count": len(chunks),
-                        "processed_at": datetime.now().isoformat(),
-                        "file_size": pdf_file.stat().st_size
-                    }
-
-                    # Индексируем чанки
-                    self.chunk_index[filename] = chunks
-
-                    updated_count += 1
-                    print(f"✅ Обработан: {filename} ({metadata['pages']} стр., {len(chunks)} чанков)")
-                else:
-                    print(f"⚠️ Пустой текст в файле: {filename}")
+                pending[str(pdf_file)] = (file_hash, st)
 
             except Exception as e:
                 print(f"❌ Ошибка обработки {pdf_file}: {e}")
                 logger.error(f"Ошибка обработки {pdf_file}: {e}")
 
+        if pending:
+            # Разбор PDF упирается в CPU - обрабатываем файлы параллельно в процессах
+            remaining = dict.fromkeys(pending)
+            try:
+                for result in _cpu_pool.map(_process_pdf, list(pending), chunksize=1):
+                    del remaining[result["path"]]
+                    if self._store_processed(result, pending):
+                        updated_count += 1
+            except BrokenProcessPool as e:
+                # Воркер упал (segfault/OOM на "плохом" PDF) - полученные результаты уже сохранены,
+                # оставшиеся файлы разбираем по одному, чтобы пропустить только виновный
+                logger.error(f"Процесс разбора PDF аварийно завершился: {e}")
+                _restart_cpu_pool()
+                for path in remaining:
+                    try:
+                        result = _cpu_pool.submit(_process_pdf, path).result()
+                    except BrokenProcessPool:
+                        print(f"❌ Ошибка обработки {path}: процесс разбора аварийно завершился")
+                        logger.error(f"Ошибка обработки {path}: процесс разбора аварийно завершился")
+                        _restart_cpu_pool()
+                        continue
+                    if self._store_processed(result, pending):
+                        updated_count += 1
+
+        if self._dirty_files:
+            self.rebuild_postings()
+
+        # Сохраняем кэш один раз после обработки всех файлов
+        self._maybe_save()
+
         if updated_count > 0:
-            self.save_cache()
             print(f"🔄 Обновлено документов: {updated_count}")
 
         print(f"📚 Всего в кэше: {len(self.documents_cache)} документов")
-        total_chunks = sum(len(chunks) for chunks in self.chunk_index.values())
-        print(f"🧩 Всего чанков: {total_chunks}")
+        print(f"🧩 Всего чанков: {self._chunk_total}")
 
-    def search_with_semantic(self, question: str, max_results: int = 5) -> List[Dict]:
-        """Семантический поиск по чанкам"""
-        question_lower = question.lower()
-        question_words = set(re.findall(r'\b[a-zA-Zа-яА-ЯёЁ]{3,}\b', question_lower))
+    def _store_processed(self, result: Dict, pending: Dict[str, Tuple[str, os.stat_result]]) -> bool:
+        """Заносим результат разбора файла в кэш и индекс (True - документ обновлен)"""
+        pdf_file = Path(result["path"])
+        filename = pdf_file.name
 
-        results = []
+        if result.get("error"):
+            print(f"❌ Ошибка обработки {pdf_file}: {result['error']}")
+            logger.error(f"Ошибка обработки {pdf_file}: {result['error']}")
+            return False
+
+        chunks = result["chunks"]
+        if chunks is None:
+            print(f"⚠️ Пустой текст в файле: {filename}")
+            return False
+
+        # Убираем полностью повторяющиеся чанки (повторы страниц)
+        unique_chunks = []
+        seen = set()
+        for chunk in chunks:
+            if chunk["dedup_hash"] in seen:
+                continue
+            seen.add(chunk["dedup_hash"])
+            unique_chunks.append(chunk)
+        chunks = unique_chunks
+
+        metadata = result["metadata"]
+        file_hash, st = pending[result["path"]]
+
+        # Сохраняем в кэш
+        old_doc = self.documents_cache.get(filename)
+        if old_doc:
+            self._size_total -= old_doc.get("file_size", 0)
+        self._size_total += st.st_size
+        self.documents_cache[filename] = {
+            "file_hash": file_hash,
+            "metadata": metadata,
+            "text_preview": result["text_preview"],
+            "chunk_count": len(chunks),
+            "processed_at": datetime.now().isoformat(),
+            "file_size": st.st_size,
+            "mtime_ns": st.st_mtime_ns,
+            "tables_extracted": EXTRACT_TABLES,
+            "lower_name": filename.lower(),
+            "standard_number": self.extract_standard_number(filename)
+        }
+
+        # Индексируем чанки
+        self._chunk_total += len(chunks) - len(self.chunk_index.get(filename, ()))
+        self.chunk_index[filename] = chunks
+        self._dirty_files.add(filename)
+        self._dirty = True
+
+        print(f"✅ Обработан: {filename} ({metadata['pages']} стр., {len(chunks)} чанков)")
+        return True
+
+    def rebuild_postings(self):
+        """Строим инвертированный индекс по словам чанков"""
+        postings: Dict[str, List[Tuple[str, int]]] = defaultdict(list)
 
         for filename, chunks in self.chunk_index.items():
-            for chunk in chunks:
-                chunk_text = chunk["text"].lower()
-                chunk_keywords = chunk.get("keywords", [])
-
-                # Вычисляем релевантность
-                score = 0
-
-                # 1. Поиск точных совпадений слов
-                for word in question_words:
-                    if word in chunk_text:
-                        score += 2
-
-                # 2. Поиск по ключевым словам чанка
-                for kw_entry in chunk_keywords:
-                    kw = kw_entry.split(':')[0]
-                    if kw in question_words:
-                        score += 3
-
-                # 3. Поиск по названию документа
-                if any(word in filename.lower() for word in question_words):
-                    score += 5
-
-                # 4. Поиск по номеру ГОСТ/ISO
-                doc_standard = self.extract_standard_number(filename)
-                if doc_standard and doc_standard in question:
-                    score += 10
-
-                if score > 0:
-                    results.append({
-                        "score": score,
-                        "text": chunk["text"],
-                        "source": filename,
-                        "page": chunk.get("page", 0),
-                        "chunk_type": chunk.get("chunk_type", "unknown")
-                    })
-
-        # Сортируем по релевантности
-        results.sort(key=lambda x: x["score"], reverse=True)
-
-        # Убираем дубликаты (похожий текст)
-        unique_results = []
-        seen_texts = set()
-
-        for result in results[:max_results * 2]:  # Берем больше для фильтрации
-            text_hash = hashlib.md5(result["text"][:200].encode()).hexdigest()
-            if text_hash not in seen_texts:
-                seen_texts.add(text_hash)
-                unique_results.append(result)
-                if len(unique_results) >= max_results:
+            for idx, chunk in enumerate(chunks):
+                for word in chunk["token_set"]:
+                    postings[word].append((filename, idx))
+
+        self.postings = dict(postings)
+
+    def search_with_semantic(self, question: str, max_results: int = 5) -> List[Dict]:
+        """Семантический поиск по чанкам"""
+        question_lower = question.lower()
+        question_words = set(_WORD_RE.findall(question_lower))
+
+        # Вычисляем релевантность только для чанков, где встречаются слова вопроса
+        candidates = {(filename, idx)
+                      for word in question_words
+                      for filename, idx in self.postings.get(word, ())}
+
+        # Бонусы за название документа и номер стандарта считаем один раз на файл
+        file_bonus: Dict[str, int] = {}
+        for filename in self.chunk_index:
+            doc = self.documents_cache[filename]
+            bonus = 0
+
+            # 3. Поиск по названию документа
+            lower_name = doc["lower_name"]
+            if any(word in lower_name for word in question_words):
+                bonus += 5
+
+            # 4. Поиск по номеру ГОСТ/ISO
+            doc_standard = doc["standard_number"]
+            if doc_standard and doc_standard in question:
+                bonus += 10
+
+            if bonus:
+                file_bonus[filename] = bonus
+
+        # Куча из (-релевантность, порядковый номер, файл, чанк): номер сохраняет порядок при равной релевантности
+        heap: List[Tuple[int, int, str, int]] = []
+        for filename, idx in sorted(candidates):
+            chunk = self.chunk_index[filename][idx]
+
+            # 1. Поиск точных совпадений слов
+            score = 2 * len(question_words & chunk["token_set"])
+
+            # 2. Поиск по ключевым словам чанка
+            for kw, _ in chunk.get("keywords", []):
+                if kw in question_words:
+                    score += 3
+
+            heap.append((-(score + file_bonus.get(filename, 0)), len(heap), filename, idx))
+
+        # Чанки без совпавших слов набирают только бонус файла - в выдачу могут попасть лишь первые из них
+        for filename, bonus in file_bonus.items():
+            taken = 0
+            for idx in range(len(self.chunk_index[filename])):
+                if taken == max_results:
                     break
+                if (filename, idx) not in candidates:
+                    heap.append((-bonus, len(heap), filename, idx))
+                    taken += 1
 
-        return unique_results
+        heapq.heapify(heap)
+
+        # Словари результатов строим только для лучших чанков, пропуская одинаковые (например, копии файла)
+        results = []
+        seen = set()
+        while heap and len(results) < max_results:
+            neg_score, _, filename, idx = heapq.heappop(heap)
+            chunk = self.chunk_index[filename][idx]
+            if chunk["dedup_hash"] in seen:
+                continue
+            seen.add(chunk["dedup_hash"])
+            results.append({
+                "score": -neg_score,
+                "text": chunk["text"],
+                "source": filename,
+                "page": chunk.get("page", 0),
+                "chunk_type": chunk.get("chunk_type", "unknown")
+            })
+
+        return results
 
     def extract_standard_number(self, filename: str) -> Optional[str]:
         """Извлекаем номер стандарта из названия файла"""
-        patterns = [
-            r'(ГОСТ\s*[0-9.-]+)',
-            r'(ISO\s*[0-9.-]+)',
-            r'(СТ\s*[0-9.-]+)',
-            r'(EN\s*[0-9.-]+)',
-            r'([0-9.-]+\s*ГОСТ)',
-            r'([0-9.-]+\s*ISO)'
-        ]
+        return _standard_number(filename)
+
+    async def get_session(self) -> aiohttp.ClientSession:
+        """HTTP-сессия с пулом соединений, переиспользуемая между запросами"""
+        if self._http_session is None or self._http_session.closed:
+            self._http_session = aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(total=INTERNET_TIMEOUT),
+                connector=aiohttp.TCPConnector(limit=20, ttl_dns_cache=300)
+            )
+        return self._http_session
 
-        for pattern in patterns:
-            match = re.search(pattern, filename, re.IGNORECASE)
-            if match:
-                return match.group(1)
-        return None
+    async def close(self):
+        """Закрываем HTTP-сессию"""
+        if self._http_session is not None and not self._http_session.closed:
+            await self._http_session.close()
+        self._http_session = None
 
     async def search_internet_fallback(self, question: str) -> Optional[str]:
         """Поиск в интернете как запасной вариант (использует DuckDuckGo)"""
         try:
             # Используем DuckDuckGo Instant Answer API
-            async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=INTERNET_TIMEOUT)) as session:
-                url = f"https://api.duckduckgo.com/"
-                params = {
-                    'q': question,
-                    'format': 'json',
-                    'no_html': '1',
-                    'skip_disambig': '1'
-                }
-
-                async with session.get(url, params=params) as response:
-                    if response.status == 200:
-                        data = await response.json()
-
-                        if data.get('AbstractText'):
-                            return data['AbstractText']
-                        elif data.get('RelatedTopics'):
-                            first_topic = data['RelatedTopics'][0]
-                            if isinstance(first_topic, dict) and 'Text' in first_topic:
-                                return first_topic['Text'][:500]
-                            elif isinstance(first_topic, str):
-                                return first_topic[:500]
+            session = await self.get_session()
+            url = f"https://api.duckduckgo.com/"
+            params = {
+                'q': question,
+                'format': 'json',
+                'no_html': '1',
+                'skip_disambig': '1'
+            }
+
+            async with session.get(url, params=params) as response:
+                if response.status == 200:
+                    data = await response.json()
+
+                    if data.get('AbstractText'):
+                        return data['AbstractText']
+                    elif data.get('RelatedTopics'):
+                        first_topic = data['RelatedTopics'][0]
+                        if isinstance(first_topic, dict) and 'Text' in first_topic:
+                            return first_topic['Text'][:500]
+                        elif isinstance(first_topic, str):
+                            return first_topic[:500]
 
             return None
 
@@ -439,6 +789,31 @@ class AdvancedPDFProcessor:
             return None
 
 
+_worker_processor: Optional[AdvancedPDFProcessor] = None
+
+
+def _process_pdf(path_str: str) -> Dict:
+    """Извлечение текста и разбиение на чанки в дочернем процессе"""
+    global _worker_processor
+    if _worker_processor is None:
+        _worker_processor = AdvancedPDFProcessor(autoload=False)
+
+    pdf_file = Path(path_str)
+    result = {"path": path_str, "metadata": {}, "text_preview": "", "chunks": None, "error": None}
+
+    try:
+        text, metadata = _worker_processor.extract_text_advanced(pdf_file, need_tables=EXTRACT_TABLES)
+        result["metadata"] = metadata
+
+        if text and len(text.strip()) > 100:
+            result["text_preview"] = text[:1000]
+            result["chunks"] = _worker_processor.chunk_text_intelligently(text, pdf_file.name)
+    except Exception as e:
+        result["error"] = str(e)
+
+    return result
+
+
 class SmartPDFAssistant:
     """Умный ассистент с улучшенной обработкой PDF и доступом к интернету"""
 
@@ -446,35 +821,83 @@ class SmartPDFAssistant:
         self.token = token
         self.processor = AdvancedPDFProcessor()
         self.application = None
+        self._ollama_ok: Optional[bool] = None
+        # Token bucket на чат: chat_id -> (доступные токены, время последнего пересчета)
+        self._chat_buckets: Dict[int, Tuple[float, float]] = {}
+        # Готовые ответы: хеш нормализованного вопроса -> текст ответа
+        self._answer_cache: LRUCache = LRUCache(maxsize=ANSWER_CACHE_SIZE)
+        # Очереди отправки по чатам: части длинных ответов уходят в фоне по порядку
+        self._send_queues: Dict[int, asyncio.Queue] = {}
+        self._send_tasks: Dict[int, asyncio.Task] = {}
+        # update_id уже отвеченных сообщений в порядке ответа (сохраняются между перезапусками)
+        self._handled: Dict[int, None] = self._load_handled()
+        # Обработчики кнопок по callback_data
+        self._callback_dispatch = {
+            'list_docs': self.show_documents,
+            'reload_docs': self.reload_documents,
+            'status': self.show_status,
+        }
 
-    def check_ollama(self) -> bool:
-        """Проверяем подключение к Ollama"""
+    def _load_handled(self) -> Dict[int, None]:
+        """Читаем сохраненные update_id (при отсутствии или порче файла - пусто)"""
         try:
-            response = requests.get("http://localhost:11434/api/tags", timeout=10)
-
-            if response.status_code == 200:
-                data = response.json()
-                models = data.get('models', [])
-
-                model_names = []
-                for model in models:
-                    if 'name' in model:
-                        model_names.append(model['name'])
-                    elif 'model' in model:
-                        model_names.append(model['model'])
+            ids = orjson.loads(Path(HANDLED_FILE).read_bytes())['handled']
+            return dict.fromkeys(int(update_id) for update_id in ids[-HANDLED_KEEP:])
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logger.warning(f"Не удалось прочитать {HANDLED_FILE}: {e}")
+            return {}
+
+    def _mark_handled(self, update_id: int):
+        """Запоминаем, что ответ на обновление доставлен, чтобы не отвечать повторно после перезапуска"""
+        # update_id не обязательно растут (после недели простоя Telegram выбирает новый случайно),
+        # поэтому храним сами id, а не границу
+        self._handled[update_id] = None
+        if len(self._handled) > HANDLED_KEEP:
+            del self._handled[next(iter(self._handled))]
+        try:
+            Path(HANDLED_FILE).write_bytes(orjson.dumps({'handled': list(self._handled)}))
+        except OSError as e:
+            logger.warning(f"Не удалось сохранить {HANDLED_FILE}: {e}")
 
-                print(f"🤖 Доступные модели: {', '.join(model_names)}")
+    async def check_ollama(self) -> bool:
+        """Проверяем подключение к Ollama (результат запоминается)"""
+        if self._ollama_ok is not None:
+            return self._ollama_ok
 
-                for name in model_names:
-                    if OLLAMA_MODEL in name:
-                        print(f"✅ Модель {OLLAMA_MODEL} найдена")
-                        return True
+        self._ollama_ok = await self._fetch_ollama_status()
+        return self._ollama_ok
 
-                print(f"❌ Модель {OLLAMA_MODEL} не найдена")
-                return False
-            else:
-                print(f"❌ Ошибка HTTP: {response.status_code}")
-                return False
+    async def _fetch_ollama_status(self) -> bool:
+        """Запрашиваем список моделей у Ollama"""
+        try:
+            session = await self.processor.get_session()
+            async with session.get("http://localhost:11434/api/tags",
+                                   timeout=aiohttp.ClientTimeout(total=10)) as response:
+                if response.status != 200:
+                    print(f"❌ Ошибка HTTP: {response.status}")
+                    return False
+                data = await response.json()
+
+            models = data.get('models', [])
+
+            model_names = []
+            for model in models:
+                if 'name' in model:
+                    model_names.append(model['name'])
+                elif 'model' in model:
+                    model_names.append(model['model'])
+
+            print(f"🤖 Доступные модели: {', '.join(model_names)}")
+
+            for name in model_names:
+                if OLLAMA_MODEL in name:
+                    print(f"✅ Модель {OLLAMA_MODEL} найдена")
+                    return True
+
+            print(f"❌ Модель {OLLAMA_MODEL} не найдена")
+            return False
 
         except Exception as e:
             print(f"❌ Ошибка подключения к Ollama: {e}")
@@ -486,15 +909,11 @@ class SmartPDFAssistant:
             loop = asyncio.get_event_loop()
             response = await asyncio.wait_for(
                 loop.run_in_executor(
-                    executor,
+                    None,
                     lambda: ollama.chat(
                         model=OLLAMA_MODEL,
                         messages=messages,
-                        options={
-                            'temperature': 0.3,
-                            'num_predict': 1200,
-                            'num_thread': 4  # Увеличиваем производительность
-                        }
+                        options=OLLAMA_OPTIONS
                     )
                 ),
                 timeout=timeout
@@ -507,8 +926,74 @@ class SmartPDFAssistant:
             logger.error(f"Ошибка запроса к Ollama: {e}")
             raise
 
-    async def ask_question_with_fallback(self, question: str) -> Tuple[str, str, bool]:
-        """Задаем вопрос с fallback на интернет"""
+    async def _stream_ollama(self, messages: List[Dict], msg=None, timeout: int = OLLAMA_TIMEOUT) -> Dict:
+        """Потоковый запрос к Ollama: по мере генерации показываем текст в сообщении msg"""
+        loop = asyncio.get_running_loop()
+        parts_queue: asyncio.Queue = asyncio.Queue()
+        stop = threading.Event()
+
+        def produce():
+            try:
+                for part in ollama.chat(model=OLLAMA_MODEL, messages=messages,
+                                        options=OLLAMA_OPTIONS, stream=True):
+                    if stop.is_set():
+                        break
+                    loop.call_soon_threadsafe(parts_queue.put_nowait, part['message']['content'])
+            except Exception as e:
+                loop.call_soon_threadsafe(parts_queue.put_nowait, e)
+            finally:
+                loop.call_soon_threadsafe(parts_queue.put_nowait, None)
+
+        loop.run_in_executor(None, produce)
+
+        accum: List[str] = []
+        accum_len = 0
+        shown_len = 0
+        last_edit = 0.0
+        deadline = loop.time() + timeout
+
+        try:
+            while True:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    raise asyncio.TimeoutError()
+                part = await asyncio.wait_for(parts_queue.get(), timeout=remaining)
+                if part is None:
+                    break
+                if isinstance(part, Exception):
+                    raise part
+
+                accum.append(part)
+                accum_len += len(part)
+
+                # Обновляем сообщение порциями, не чаще лимита Telegram
+                now = loop.time()
+                if (msg is not None and accum_len - shown_len >= STREAM_EDIT_MIN_CHARS and
+                        now - last_edit >= STREAM_EDIT_INTERVAL):
+                    shown_len = accum_len
+                    last_edit = now
+                    try:
+                        await msg.edit_text("".join(accum)[:MESSAGE_PART_LEN])
+                    except RetryAfter as e:
+                        # Telegram просит подождать - откладываем следующее обновление
+                        last_edit = now + e.retry_after
+                    except Exception as e:
+                        logger.debug(f"Не удалось обновить сообщение: {e}")
+
+        except asyncio.TimeoutError:
+            logger.error(f"Таймаут при запросе к Ollama (>{timeout} сек)")
+            raise
+        except Exception as e:
+            logger.error(f"Ошибка запроса к Ollama: {e}")
+            raise
+        finally:
+            # Останавливаем генерацию, если ответ больше не нужен
+            stop.set()
+
+        return {'message': {'content': "".join(accum)}}
+
+    async def ask_question_with_fallback(self, question: str, progress_msg=None) -> Tuple[str, str, bool]:
+        """Задаем вопрос с fallback на интернет (ответ уже размечен для MarkdownV2)"""
         # Поиск в документах
         search_results = self.processor.search_with_semantic(question)
 
@@ -522,7 +1007,7 @@ class SmartPDFAssistant:
                 context += f"Текст:\n{result['text'][:800]}...\n\n"
                 sources.add(result['source'])
 
-            sources_text = ", ".join(sources)
+            sources_text = _md2(", ".join(sources))
 
             prompt = f"""Ты - технический эксперт. Отвечай на основе предоставленных документов.
 
@@ -539,14 +1024,15 @@ class SmartPDFAssistant:
 ОТВЕТ:"""
 
             try:
-                response = await self.ask_ollama_with_timeout(
+                response = await self._stream_ollama(
                     messages=[
                         {"role": "system",
                          "content": "Ты - технический эксперт, который предоставляет точную информацию."},
                         {"role": "user", "content": prompt}
-                    ]
+                    ],
+                    msg=progress_msg
                 )
-                answer = response['message']['content']
+                answer = _md2(response['message']['content'])
                 answer += f"\n\n📚 *Источники:* {sources_text}"
                 return answer, "documents", True
 
@@ -561,8 +1047,8 @@ class SmartPDFAssistant:
                         ],
                         timeout=15
                     )
-                    answer = simple_response['message']['content']
-                    answer += f"\n\n📚 *Источники:* {sources_text}\n⚠️ *Примечание:* Ответ сгенерирован без глубокого анализа документов из-за таймаута"
+                    answer = _md2(simple_response['message']['content'])
+                    answer += f"\n\n📚 *Источники:* {sources_text}\n⚠️ *Примечание:* Ответ сгенерирован без глубокого анализа документов из\\-за таймаута"
                     return answer, "documents_timeout", True
                 except:
                     # Если и это не сработало, ищем в интернете
@@ -599,23 +1085,23 @@ class SmartPDFAssistant:
                     ],
                     timeout=15
                 )
-                answer = response['message']['content']
+                answer = _md2(response['message']['content'])
                 answer += "\n\n⚠️ *Примечание:* Информация взята из открытых источников в интернете"
                 return answer, "internet", True
 
             except Exception as e:
                 logger.error(f"Ошибка Ollama при обработке интернет-информации: {e}")
-                internet_fallback = f"Информация из интернета:\n{internet_info}"
+                internet_fallback = _md2(f"Информация из интернета:\n{internet_info}")
                 return internet_fallback, "internet_raw", True
 
         else:
             # Ничего не найдено
-            return "❌ К сожалению, не удалось найти информацию ни в документах, ни в интернете. Попробуйте уточнить вопрос.", "not_found", False
+            return _md2("❌ К сожалению, не удалось найти информацию ни в документах, ни в интернете. Попробуйте уточнить вопрос."), "not_found", False
 
     async def start(self, update: Update, context: CallbackContext):
         """Команда /start"""
         doc_count = len(self.processor.documents_cache)
-        chunk_count = sum(len(chunks) for chunks in self.processor.chunk_index.values())
+        chunk_count = self.processor.chunk_total
 
         welcome_text = f"""
 🤖 *Умный PDF Assistant*
@@ -724,9 +1210,11 @@ class SmartPDFAssistant:
         try:
             loop = asyncio.get_event_loop()
             await loop.run_in_executor(
-                executor,
+                None,
                 self.processor.update_documents
             )
+            # Ответы могли устареть вместе с документами
+            self._answer_cache.clear()
 
             doc_count = len(self.processor.documents_cache)
             message_text = f"✅ Документы обновлены!\nЗагружено: {doc_count} документов"
@@ -741,7 +1229,7 @@ class SmartPDFAssistant:
                 await message.edit_text(message_text, reply_markup=keyboard)
 
         except Exception as e:
-            error_msg = f"❌ Ошибка при обновлении документов: {str(e)[:100]}"
+            error_msg = f"❌ Ошибка при обновлении документов: {_short(e, 100)}"
             if edit_message:
                 await query.edit_message_text(error_msg)
             else:
@@ -749,59 +1237,176 @@ class SmartPDFAssistant:
 
     async def handle_message(self, update: Update, context: CallbackContext):
         """Обработка вопросов"""
+        # Уже отвеченное до перезапуска сообщение не обрабатываем заново
+        if update.update_id in self._handled:
+            logger.info(f"Пропускаем уже обработанное обновление {update.update_id}")
+            return
+
         question = update.message.text.strip()
+        chat_id = update.effective_chat.id
+        reply = update.message.reply_text
 
         if not question:
-            await update.message.reply_text("Пожалуйста, введите вопрос.")
+            await self._send_in_order(chat_id, reply, "Пожалуйста, введите вопрос.")
             return
 
-        # Показываем "печатает..."
-        await context.bot.send_chat_action(
-            chat_id=update.effective_chat.id,
-            action="typing"
+        # Повторный вопрос - отвечаем из кэша без поиска и генерации
+        question_key = hashlib.blake2b(question.lower().encode(), digest_size=16).digest()
+        cached_response = self._answer_cache.get(question_key)
+        if cached_response is not None:
+            await self._send_response(update, cached_response)
+            return
+
+        # Сообщение, в котором по мере генерации показывается ответ
+        progress_msg = await self._send_in_order(chat_id, reply, "🤖 Готовлю ответ...")
+
+        # Показываем "печатает..." все время, пока готовится ответ
+        stop_typing = asyncio.Event()
+        typing_task = asyncio.create_task(
+            self._keep_typing(context.bot, chat_id, stop_typing)
         )
 
         try:
             # Получаем ответ с fallback
-            answer, source_type, success = await self.ask_question_with_fallback(question)
+            answer, source_type, success = await self.ask_question_with_fallback(question, progress_msg)
 
             # Форматируем ответ
-            response = f"❓ *Вопрос:* {question}\n\n"
+            response = f"❓ *Вопрос:* {_md2(question)}\n\n"
             response += f"🤖 *Ответ:*\n{answer}\n\n"
+            response += SOURCE_SUFFIXES.get(source_type, NOT_FOUND_SUFFIX)
 
-            if source_type == "documents":
-                response += "📚 *Источник:* Документы из папки"
-            elif source_type == "documents_timeout":
-                response += "📚⏱️ *Источник:* Документы (обработка с таймаутом)"
-            elif source_type == "internet":
-                response += "🌐 *Источник:* Интернет (открытые источники)"
-            elif source_type == "internet_raw":
-                response += "🌐 *Источник:* Необработанные данные из интернета"
-            else:
-                response += "⚠️ *Источник:* Информация не найдена"
-
-            # Отправляем ответ частями если он слишком длинный
-            if len(response) > 4000:
-                parts = [response[i:i + 4000] for i in range(0, len(response), 4000)]
-                for part in parts:
-                    await update.message.reply_text(part, parse_mode='Markdown')
-                    await asyncio.sleep(0.5)
-            else:
-                await update.message.reply_text(response, parse_mode='Markdown')
+            # Запоминаем полноценные ответы (урезанный из-за таймаута не кэшируем)
+            if success and source_type != "documents_timeout":
+                self._answer_cache[question_key] = response
+
+            await self._send_response(update, response, progress_msg)
 
         except asyncio.TimeoutError:
             logger.error(f"Таймаут обработки вопроса: {question}")
-            await update.message.reply_text(
-                "⏱️ *Таймаут обработки*\n"
-                "Запрос занял слишком много времени. Попробуйте:\n"
-                "1. Переформулировать вопрос\n"
-                "2. Задать более конкретный вопрос\n"
-                "3. Проверить доступность модели Ollama",
-                parse_mode='Markdown'
-            )
+            await self._drop_message(progress_msg)
+            await self._send_in_order(chat_id, reply, TIMEOUT_MSG, parse_mode='Markdown')
         except Exception as e:
-            logger.error(f"Ошибка обработки вопроса: {e}\n{traceback.format_exc()}")
-            await update.message.reply_text(f"❌ Ошибка: {str(e)[:200]}")
+            logger.error("Ошибка обработки вопроса: %s", e, exc_info=True)
+            await self._drop_message(progress_msg)
+            await self._send_in_order(chat_id, reply, f"❌ Ошибка: {_short(e)}")
+        finally:
+            stop_typing.set()
+            await typing_task
+
+    async def _send_response(self, update: Update, response: str, progress_msg=None):
+        """Отправляем ответ: заменяем им промежуточное сообщение или шлем частями, если он слишком длинный.
+        Обновление считается обработанным, когда доставлена последняя часть ответа"""
+        update_id = update.update_id
+        chat_id = update.effective_chat.id
+        reply = update.message.reply_text
+        n = len(response)
+        if n > MESSAGE_PART_LEN:
+            if progress_msg is not None:
+                await self._drop_message(progress_msg)
+            parts = _split_md2(response)
+            enqueue = self._enqueue_send
+            # Каждую часть ставим в очередь, когда известна следующая: последняя отмечает обновление
+            part = next(parts)
+            for next_part in parts:
+                enqueue(chat_id, reply, part, parse_mode='MarkdownV2')
+                part = next_part
+            enqueue(chat_id, reply, part, on_sent=lambda: self._mark_handled(update_id), parse_mode='MarkdownV2')
+            return
+
+        if progress_msg is not None:
+            await self._send_in_order(chat_id, progress_msg.edit_text, response, parse_mode='MarkdownV2')
+        else:
+            await self._send_in_order(chat_id, reply, response, parse_mode='MarkdownV2')
+        self._mark_handled(update_id)
+
+    async def _send_in_order(self, chat_id: int, send, text: str, **kwargs):
+        """Отправляем сразу, но после уже поставленных в очередь частей ответов этого чата и с учетом его лимита"""
+        queue = self._send_queues.get(chat_id)
+        if queue is not None:
+            await queue.join()
+        return await self._send_paced(chat_id, send, text, **kwargs)
+
+    def _enqueue_send(self, chat_id: int, send, text: str, on_sent=None, **kwargs):
+        """Ставим сообщение в очередь чата; очередь разбирается фоновой задачей.
+        on_sent вызывается после успешной отправки"""
+        queue = self._send_queues.get(chat_id)
+        if queue is None:
+            queue = self._send_queues[chat_id] = asyncio.Queue()
+            self._send_tasks[chat_id] = asyncio.create_task(self._drain_send_queue(chat_id, queue))
+        queue.put_nowait((send, text, on_sent, kwargs))
+
+    async def _drain_send_queue(self, chat_id: int, queue: asyncio.Queue):
+        """Отправляем сообщения чата строго по порядку, пока очередь не опустеет"""
+        while True:
+            send, text, on_sent, kwargs = await queue.get()
+            try:
+                try:
+                    await self._send_paced(chat_id, send, text, **kwargs)
+                except BadRequest as e:
+                    if 'parse_mode' not in kwargs:
+                        raise
+                    # Разрезанная на части разметка может не разобраться - шлем как обычный текст
+                    logger.warning("Часть ответа не прошла разметку (%s), отправляю без нее", e)
+                    if kwargs.pop('parse_mode') == 'MarkdownV2':
+                        text = _MD2_ESCAPE_RE.sub(r'\1', text)
+                    await self._send_paced(chat_id, send, text, **kwargs)
+                if on_sent is not None:
+                    on_sent()
+            except Exception as e:
+                logger.error("Не удалось отправить сообщение в чат %s: %s", chat_id, e)
+            finally:
+                queue.task_done()
+
+            if queue.empty():
+                del self._send_queues[chat_id]
+                del self._send_tasks[chat_id]
+                self._prune_chat_buckets()
+                return
+
+    def _prune_chat_buckets(self):
+        """Забываем token bucket чатов, у которых он уже полностью восстановился"""
+        now = time.monotonic()
+        for chat_id, (tokens, last) in list(self._chat_buckets.items()):
+            if tokens + (now - last) * CHAT_SEND_RATE >= CHAT_SEND_BURST:
+                del self._chat_buckets[chat_id]
+
+    async def _send_paced(self, chat_id: int, send, text: str, **kwargs):
+        """Отправка с учетом лимитов Telegram: token bucket на чат и повтор при RetryAfter"""
+        # Резервируем токен сразу, чтобы параллельные отправки в тот же чат не обогнали друг друга
+        now = time.monotonic()
+        tokens, last = self._chat_buckets.get(chat_id, (CHAT_SEND_BURST, now))
+        tokens = min(CHAT_SEND_BURST, tokens + (now - last) * CHAT_SEND_RATE) - 1
+        self._chat_buckets[chat_id] = (tokens, now)
+        if tokens < 0:
+            await asyncio.sleep(-tokens / CHAT_SEND_RATE)
+
+        for attempt in range(SEND_RETRIES):
+            try:
+                return await send(text, **kwargs)
+            except RetryAfter as e:
+                if attempt == SEND_RETRIES - 1:
+                    raise
+                # Ждем, сколько просит Telegram, с небольшим случайным разбросом
+                await asyncio.sleep(e.retry_after + random.uniform(0, 0.3))
+
+    async def _keep_typing(self, bot, chat_id: int, stop: asyncio.Event):
+        """Повторяем статус "печатает..." (он гаснет через ~5 сек), пока не выставлен stop"""
+        while not stop.is_set():
+            try:
+                await bot.send_chat_action(chat_id=chat_id, action="typing")
+            except Exception as e:
+                logger.debug(f"Не удалось отправить статус: {e}")
+            try:
+                await asyncio.wait_for(stop.wait(), timeout=4.0)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _drop_message(self, msg):
+        """Удаляем промежуточное сообщение (ошибки удаления не критичны)"""
+        try:
+            await msg.delete()
+        except Exception as e:
+            logger.debug(f"Не удалось удалить сообщение: {e}")
 
     async def show_status(self, update: Update, context: CallbackContext):
         """Показать статус"""
@@ -818,20 +1423,14 @@ class SmartPDFAssistant:
             edit_message = False
 
         doc_count = len(self.processor.documents_cache)
-        chunk_count = sum(len(chunks) for chunks in self.processor.chunk_index.values())
-        total_size = sum(doc.get("file_size", 0) for doc in self.processor.documents_cache.values())
-
-        status_text = f"""
-📊 *Статус системы:*
+        chunk_count = self.processor.chunk_total
+        total_size = self.processor.size_total
 
-🤖 *Модель:* {OLLAMA_MODEL}
-📚 *Документов:* {doc_count}
-🧩 *Чанков:* {chunk_count}
-💾 *Общий размер:* {total_size / 1024 / 1024:.1f} MB
-⏱️ *Таймаут Ollama:* {OLLAMA_TIMEOUT} сек
-
-📁 *Папка с документами:* `{PDF_FOLDER}`
-"""
+        status_text = (f"{STATUS_HEADER}"
+                       f"📚 *Документов:* {doc_count}\n"
+                       f"🧩 *Чанков:* {chunk_count}\n"
+                       f"💾 *Общий размер:* {total_size / 1048576:.1f} MB\n"
+                       f"{STATUS_FOOTER}")
 
         if edit_message:
             await query.edit_message_text(status_text, parse_mode='Markdown')
@@ -843,45 +1442,87 @@ class SmartPDFAssistant:
         query = update.callback_query
         await query.answer()
 
-        if query.data == 'list_docs':
-            await self.show_documents(update, context)
-        elif query.data == 'reload_docs':
-            await self.reload_documents(update, context)
-        elif query.data == 'status':
-            await self.show_status(update, context)
+        handler = self._callback_dispatch.get(query.data)
+        if handler:
+            await handler(update, context)
 
     async def error_handler(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработчик ошибок"""
         logger.error(f"Ошибка: {context.error}")
 
         if update and update.effective_chat:
+            # Короткий таймаут: при недоступном Telegram не держим обработчик до connect_timeout
             try:
-                await context.bot.send_message(
-                    chat_id=update.effective_chat.id,
-                    text=f"⚠️ Произошла ошибка: {str(context.error)[:200]}"
+                await asyncio.wait_for(
+                    context.bot.send_message(
+                        chat_id=update.effective_chat.id,
+                        text=f"⚠️ Произошла ошибка: {_short(context.error)}"
+                    ),
+                    timeout=3.0
                 )
-            except:
-                pass
+            except (TelegramError, asyncio.TimeoutError) as send_err:
+                logger.warning("Не удалось отправить сообщение об ошибке: %r", send_err)
+
+    async def on_stop(self, application: Application):
+        """Перед остановкой даем очередям отправки дописать ответы (бот еще может отправлять сообщения)"""
+        tasks = list(self._send_tasks.values())
+        if not tasks:
+            return
+
+        _, pending = await asyncio.wait(tasks, timeout=SEND_DRAIN_TIMEOUT)
+        if pending:
+            logger.warning(f"Не дождались отправки ответов в {len(pending)} чат(ов), отменяем")
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+            self._send_tasks.clear()
+            self._send_queues.clear()
+
+    async def on_shutdown(self, application: Application):
+        """Освобождаем ресурсы при остановке бота"""
+        await self.processor.close()
+        _cpu_pool.shutdown(wait=False, cancel_futures=True)
 
     def run(self):
         """Запуск бота"""
         # Проверяем Ollama
         print("🔍 Проверяем подключение к Ollama...")
-        if not self.check_ollama():
+        # Этот же цикл событий затем использует run_polling, поэтому HTTP-сессия остается рабочей
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        loop.set_default_executor(_io_pool)
+        if not loop.run_until_complete(self.check_ollama()):
             print("❌ Ollama недоступен. Запустите: ollama serve")
             print(f"ℹ️ Убедитесь, что модель загружена: ollama pull {OLLAMA_MODEL}")
+            loop.run_until_complete(self.processor.close())
             return
 
-        print("✅ Ollama доступен!")
-        print(f"📁 Загружено документов: {len(self.processor.documents_cache)}")
-
-        # Создаем приложение с увеличенными таймаутами
+        doc_n = len(self.processor.documents_cache)
+        print(f"✅ Ollama доступен!\n📁 Загружено документов: {doc_n}")
+
+        # Создаем приложение с увеличенными таймаутами и пулом соединений HTTP/2
+        request = HTTPXRequest(
+            connection_pool_size=TELEGRAM_POOL_SIZE,
+            http_version="2",
+            read_timeout=TELEGRAM_TIMEOUT,
+            write_timeout=TELEGRAM_TIMEOUT,
+            connect_timeout=TELEGRAM_CONNECT_TIMEOUT,
+            pool_timeout=TELEGRAM_TIMEOUT
+        )
+        # Для getUpdates отдельный запрос: long polling не должен занимать соединения для ответов
+        get_updates_request = HTTPXRequest(
+            http_version="2",
+            read_timeout=TELEGRAM_TIMEOUT,
+            write_timeout=TELEGRAM_TIMEOUT,
+            connect_timeout=TELEGRAM_CONNECT_TIMEOUT,
+            pool_timeout=TELEGRAM_TIMEOUT
+        )
         application = Application.builder() \
             .token(self.token) \
-            .read_timeout(TELEGRAM_TIMEOUT) \
-            .write_timeout(TELEGRAM_TIMEOUT) \
-            .connect_timeout(TELEGRAM_TIMEOUT) \
-            .pool_timeout(TELEGRAM_TIMEOUT) \
+            .request(request) \
+            .get_updates_request(get_updates_request) \
+            .post_stop(self.on_stop) \
+            .post_shutdown(self.on_shutdown) \
             .build()
 
         self.application = application
@@ -899,21 +1540,27 @@ class SmartPDFAssistant:
 
         # Запускаем
         logger.info("🤖 Бот запущен...")
-        print("\n" + "=" * 60)
-        print("🚀 Умный PDF Assistant запущен!")
-        print(f"📁 Папка: {PDF_FOLDER}")
-        print(f"🧠 Модель: {OLLAMA_MODEL}")
-        print(f"📚 Документов: {len(self.processor.documents_cache)}")
-        print(f"⏱️ Таймаут Ollama: {OLLAMA_TIMEOUT} сек")
-        print("🌐 Интернет: ДОСТУПЕН")
-        print("=" * 60)
-        print("\nНажмите Ctrl+C для остановки.\n")
-
-        # Запускаем с обработкой исключений
+        print("\n".join([
+            "",
+            "=" * 60,
+            "🚀 Умный PDF Assistant запущен!",
+            f"📁 Папка: {PDF_FOLDER}",
+            f"🧠 Модель: {OLLAMA_MODEL}",
+            f"📚 Документов: {doc_n}",
+            f"⏱️ Таймаут Ollama: {OLLAMA_TIMEOUT} сек",
+            "🌐 Интернет: ДОСТУПЕН",
+            "=" * 60,
+            "",
+            "Нажмите Ctrl+C для остановки.",
+            "",
+        ]))
+
+        # Запускаем с обработкой исключений. Накопившиеся за время остановки сообщения не теряем:
+        # уже отвеченные отсеиваются в handle_message по сохраненным update_id (HANDLED_FILE)
         try:
             application.run_polling(
                 allowed_updates=Update.ALL_TYPES,
-                drop_pending_updates=True
+                drop_pending_updates=False
             )
         except KeyboardInterrupt:
             print("\n\n🛑 Бот остановлен пользователем")